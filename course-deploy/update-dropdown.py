@@ -4,12 +4,101 @@ Post-render script to inject version dropdown and archive versions into Quarto-g
 Designed for Cambridge Informatics Training course materials with versioning.
 """
 
+import html
+import mmap
+import os
 import re
-import glob
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from datetime import datetime
 import sys
 
+# Patterns compiled once at import time rather than per file
+_MARKER_RE = re.compile(
+    r"(<!--\s*AUTOMATIC_VERSIONS_START\s*-->)(.*?)(<!--\s*AUTOMATIC_VERSIONS_END\s*-->)",
+    re.DOTALL | re.IGNORECASE,
+)
+_LIST_GROUP_RE = re.compile(
+    r'(<div\b[^>]*\bclass\s*=\s*"[^"]*\blist-group\b[^"]*"[^>]*>)(.*?)(</div>)',
+    re.DOTALL | re.IGNORECASE,
+)
+_VERSION_DIR_RE = re.compile(r"^\d{4}\.\d{2}\.\d{2}$")
+
+_MONTHS = (
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+)
+
+# Dropdown fragments defined once so they aren't rebuilt per call
+_VERSION_BADGE_TMPL = (
+    ' <span class="version-badge" aria-hidden="true">{version}</span>'
+)
+
+_DROPDOWN_HEADER_TMPL = """
+  <li id="version-dropdown" class="nav-item dropdown">
+    <a class="nav-link dropdown-toggle" href="#" id="nav-menu-versions" role="link" data-bs-toggle="dropdown" aria-expanded="false">
+      <span class="menu-text">Version:</span>{badge}
+    </a>
+    <ul class="dropdown-menu" aria-labelledby="nav-menu-versions">
+      <li>
+        <a class="dropdown-item" href="/{prefix}/index.html">
+          <span class="dropdown-text">Latest</span>
+        </a>
+      </li>"""
+
+_DROPDOWN_ITEM_TMPL = """
+      <li>
+        <a class="dropdown-item" href="/{prefix}/archive/{version}/index.html">
+          <span class="dropdown-text">{version}</span>
+        </a>
+      </li>"""
+
+_DROPDOWN_MORE_TMPL = """
+      <li><hr class="dropdown-divider"></li>
+      <li>
+        <a class="dropdown-item" href="/{prefix}/versions.html">
+          <span class="dropdown-text">More versions...</span>
+        </a>
+      </li>"""
+
+_DROPDOWN_FOOTER = """
+    </ul>
+  </li>"""
+
+# CSS to remove bullet points from the dropdown list; injected into <head>
+# once per page rather than shipped with every dropdown payload
+_DROPDOWN_CSS = (
+    '<style id="version-dropdown-css">#version-dropdown { list-style: none; }</style>'
+)
+
+# Style block that older releases of this script prepended to every injected
+# dropdown; stripped so re-deploys don't accumulate duplicates
+_LEGACY_DROPDOWN_CSS = """
+    <style>
+    #version-dropdown {
+      list-style: none;
+    }
+    </style>
+    """
+
+# Files under this prefix additionally get the deprecation warning
+_ARCHIVE_PREFIX = os.path.join("_site", "archive") + os.sep
+
+# Per-worker state set by _init_worker so the pool doesn't pickle it per task
+_DROPDOWN_CACHE = None
+_PREFIX = None
+_ARCHIVE_HTML = None
+_VERSIONS = None
+
 
 def get_available_versions():
     """
@@ -23,19 +112,39 @@ def get_available_versions():
         for item in archive_path.iterdir():
             if item.is_dir():
                 # Validate YYYY.MM.DD format
-                if re.match(r"^\d{4}\.\d{2}\.\d{2}$", item.name):
+                if _VERSION_DIR_RE.match(item.name):
                     versions.append(item.name)
 
-    # Sort versions in reverse chronological order (newest first)
-    versions.sort(reverse=True)
+    # Sort versions in reverse chronological order (newest first), comparing
+    # (year, month, day) integer tuples computed once per entry rather than
+    # relying on the strings happening to collate chronologically
+    versions.sort(key=lambda v: tuple(map(int, v.split("."))), reverse=True)
     return versions
 
 
+def iter_html_files(root):
+    """
+    Yield paths of all .html files under root, walking with os.scandir.
+
+    Unlike glob.glob("**/*.html"), this avoids per-entry stat() calls and
+    yields lazily, so downstream work can start before the walk finishes.
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".html"):
+                    yield entry.path
+
+
 def generate_dropdown_html(versions, prefix, current_version=None):
     """
     Generate the HTML for the version dropdown.
     If current_version is provided (e.g. 'Latest' or '2025.01.15'),
     a small badge showing the current version will be appended to the label.
+    current_version must already be HTML-escaped by the caller.
     """
     display_versions = versions[:3] if versions else []
     has_more = len(versions) > 3
@@ -43,58 +152,66 @@ def generate_dropdown_html(versions, prefix, current_version=None):
     # Prepare badge HTML (small, aria-hidden so screen-readers read the menu label itself)
     badge_html = ""
     if current_version:
-        # escape current_version if necessary (here it's safe)
-        badge_html = (
-            f' <span class="version-badge" aria-hidden="true">{current_version}</span>'
-        )
+        badge_html = _VERSION_BADGE_TMPL.format(version=current_version)
 
-    dropdown_html = f"""
-  <li id="version-dropdown" class="nav-item dropdown">
-    <a class="nav-link dropdown-toggle" href="#" id="nav-menu-versions" role="link" data-bs-toggle="dropdown" aria-expanded="false">
-      <span class="menu-text">Version:</span>{badge_html}
-    </a>
-    <ul class="dropdown-menu" aria-labelledby="nav-menu-versions">
-      <li>
-        <a class="dropdown-item" href="/{prefix}/index.html">
-          <span class="dropdown-text">Latest</span>
-        </a>
-      </li>"""
+    # Collect fragments in a list and join once, avoiding repeated
+    # str concatenation (which copies the accumulated string each time)
+    parts = [_DROPDOWN_HEADER_TMPL.format(prefix=prefix, badge=badge_html)]
 
-    for version in display_versions:
-        dropdown_html += f"""
-      <li>
-        <a class="dropdown-item" href="/{prefix}/archive/{version}/index.html">
-          <span class="dropdown-text">{version}</span>
-        </a>
-      </li>"""
+    parts.extend(
+        _DROPDOWN_ITEM_TMPL.format(prefix=prefix, version=version)
+        for version in display_versions
+    )
 
     if has_more:
-        dropdown_html += f"""
-      <li><hr class="dropdown-divider"></li>
-      <li>
-        <a class="dropdown-item" href="/{prefix}/versions.html">
-          <span class="dropdown-text">More versions...</span>
-        </a>
-      </li>"""
+        parts.append(_DROPDOWN_MORE_TMPL.format(prefix=prefix))
 
-    dropdown_html += """
-    </ul>
-  </li>"""
+    parts.append(_DROPDOWN_FOOTER)
 
-    return dropdown_html
+    return "".join(parts)
 
 
 def detect_current_version_from_path(file_path):
     """
     Return 'Latest' or 'YYYY.MM.DD' based on the file path.
     """
-    p = Path(file_path).as_posix()
-    m = re.search(r"/archive/(\d{4}\.\d{2}\.\d{2})(?:/|$)", p)
-    if m:
-        return m.group(1)
+    # Called once per file; plain substring arithmetic on the walk's string
+    # paths avoids a Path allocation and a regex search per call
+    p = file_path.replace("\\", "/") if "\\" in file_path else file_path
+    i = p.find("/archive/")
+    if i == -1:
+        return "Latest"
+
+    start = i + len("/archive/")
+    segment = p[start : start + 10]
+    if (
+        len(segment) == 10
+        and segment[4] == "."
+        and segment[7] == "."
+        and segment[:4].isdigit()
+        and segment[5:7].isdigit()
+        and segment[8:].isdigit()
+        and (start + 10 == len(p) or p[start + 10] == "/")
+    ):
+        return segment
     return "Latest"
 
 
+def _format_version_date(version):
+    """
+    Format a YYYY.MM.DD version string as e.g. "January 15, 2025".
+    Returns the version unchanged if it doesn't parse as a date.
+    """
+    try:
+        year, month, day = version.split(".")
+        month, day = int(month), int(day)
+        if 1 <= month <= 12 and 1 <= day <= 31:
+            return f"{_MONTHS[month - 1]} {day:02d}, {year}"
+    except ValueError:
+        pass
+    return version
+
+
 def generate_archive_versions_html(versions, prefix):
     """
     Generate list-group-item HTML for archive versions.
@@ -118,11 +235,7 @@ def generate_archive_versions_html(versions, prefix):
 
     # Archive items
     for version in versions:
-        try:
-            date_obj = datetime.strptime(version, "%Y.%m.%d")
-            formatted_date = date_obj.strftime("%B %d, %Y")
-        except ValueError:
-            formatted_date = version
+        formatted_date = _format_version_date(version)
 
         parts.append(
             f"""<div class="list-group-item list-group-item-action">
@@ -138,50 +251,45 @@ def generate_archive_versions_html(versions, prefix):
     return "\n\n".join(parts)
 
 
-def inject_dropdown_into_html(file_path, dropdown_html):
+def inject_dropdown_into_html(content, dropdown_html):
     """
     Inject the provided dropdown_html immediately before the closing </nav> tag.
     Raises an exception if </nav> is not found.
 
-    Returns True on success.
+    Returns the modified content.
     """
-    # Add some CSS to remove bullet points from the dropdown list
-    marker_css = """
-    <style>
-    #version-dropdown {
-      list-style: none;
-    }
-    </style>
-    """
-    dropdown_html = marker_css + "\n" + dropdown_html
-
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            content = f.read()
-
-        # Remove any existing version dropdown
-        content = re.sub(
-            r'<li id="version-dropdown" class="nav-item dropdown">.*?</ul>\s*</li>',
-            "",
-            content,
-            flags=re.DOTALL | re.IGNORECASE,
-        )
-
-        # Inject directly before the last </nav>
-        if "</nav>" in content:
-            content = content.replace("</nav>", dropdown_html + "\n</nav>", 1)
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(content)
-            return True
-        else:
-            raise RuntimeError(f"⚠ Could not find closing </nav> tag in: {file_path}")
-
-    except Exception as e:
-        print(f"✗ Error updating {file_path}: {e}")
-        return False
-
-
-def inject_archive_versions_into_versions_html(file_path, archive_html):
+    # Drop style blocks left next to dropdowns by older script versions
+    if _LEGACY_DROPDOWN_CSS in content:
+        content = content.replace(_LEGACY_DROPDOWN_CSS + "\n", "")
+
+    # Make sure the dropdown CSS is present in <head>, exactly once
+    if _DROPDOWN_CSS not in content:
+        head_end = content.find("</head>")
+        if head_end != -1:
+            content = content[:head_end] + _DROPDOWN_CSS + "\n" + content[head_end:]
+
+    # Remove any existing version dropdown. The fragment always ends with
+    # </ul> followed by </li>, so scan forward for those closing tags
+    # instead of running a backtracking DOTALL regex over the whole file
+    start = content.find('<li id="version-dropdown"')
+    if start != -1:
+        end = content.find("</ul>", start)
+        if end != -1:
+            end = content.find("</li>", end)
+        if end != -1:
+            content = content[:start] + content[end + len("</li>") :]
+
+    # Inject directly before the first </nav> — that closes the top navbar
+    # the dropdown <li> belongs to; later navs are TOC/page navigation.
+    # A single find plus splice replaces the containment check + replace()
+    k = content.find("</nav>")
+    if k == -1:
+        raise RuntimeError("⚠ Could not find closing </nav> tag")
+
+    return content[:k] + dropdown_html + "\n" + content[k:]
+
+
+def inject_archive_versions_into_versions_html(content, archive_html):
     """
     Replace the contents of the automatic versions block in versions.html.
 
@@ -192,59 +300,34 @@ def inject_archive_versions_into_versions_html(file_path, archive_html):
       2. Fallback to replacing the first <div ... class="list-group">...</div>
          (legacy behaviour).
 
-    Returns True on success, False on failure.
-    """
-    try:
-        with open(file_path, "r", encoding="utf-8") as fh:
-            content = fh.read()
-
-        # 1) Marker-based replacement - on the main branch
-        start_marker = r"<!--\s*AUTOMATIC_VERSIONS_START\s*-->"
-        end_marker = r"<!--\s*AUTOMATIC_VERSIONS_END\s*-->"
-        marker_pattern = re.compile(
-            rf"({start_marker})(.*?)({end_marker})",
-            re.DOTALL | re.IGNORECASE,
-        )
-
-        if marker_pattern.search(content):
-            new_content = marker_pattern.sub(
-                r"\1\n" + archive_html + r"\3", content, count=1
-            )
-            with open(file_path, "w", encoding="utf-8") as fh:
-                fh.write(new_content)
-            print(f"✓ Replaced automatic versions block (markers) in: {file_path}")
-            return True
-
-        # 2) Fallback: find the first div with class containing 'list-group'
-        # in the already archived version.html files
-        div_pattern = re.compile(
-            r'(<div\b[^>]*\bclass\s*=\s*"[^"]*\blist-group\b[^"]*"[^>]*>)(.*?)(</div>)',
-            re.DOTALL | re.IGNORECASE,
-        )
-
-        new_content, n = div_pattern.subn(
-            r"\1" + archive_html + r"\3", content, count=1
-        )
-        if n > 0:
-            with open(file_path, "w", encoding="utf-8") as fh:
-                fh.write(new_content)
-            print(f'✓ Replaced first <div class="list-group"> block in: {file_path}')
-            return True
+    Returns a (content, replaced) tuple where replaced indicates whether
+    either strategy matched.
 
-        # Nothing matched
-        print(
-            f'⚠ Could not find automatic versions markers or a <div class="list-group"> in: {file_path}'
-        )
-        return False
+    The two patterns must stay separate: the list-group container wraps the
+    marker pair in the rendered page, so a combined leftmost-match
+    alternation would let the div arm swallow the START marker.
+    """
+    # 1) Marker-based replacement - on the main branch. The replacement is
+    # a callback so archive_html isn't interpreted as a regex template
+    new_content, n = _MARKER_RE.subn(
+        lambda m: m.group(1) + "\n" + archive_html + m.group(3), content, count=1
+    )
+    if n > 0:
+        return new_content, True
 
-    except Exception as e:
-        print(f"✗ Error updating versions in {file_path}: {e}")
-        return False
+    # 2) Fallback: find the first div with class containing 'list-group'
+    # in the already archived version.html files
+    new_content, n = _LIST_GROUP_RE.subn(
+        lambda m: m.group(1) + archive_html + m.group(3), content, count=1
+    )
+    return new_content, n > 0
 
 
-def inject_deprecation_warning(file_path, prefix):
+def inject_deprecation_warning(content, prefix):
     """
-    Inject a deprecation warning banner at the top of the HTML file.
+    Inject a deprecation warning banner at the top of the HTML content.
+
+    Returns the modified content.
     """
     warning_html = f"""
 <div id="deprecation-warning" class="callout callout-style-default callout-warning callout-titled">
@@ -261,30 +344,123 @@ Warning
 </div>
 </div>
 """
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            content = f.read()
-
-        # Skip if warning already present
-        if 'id="deprecation-warning"' in content:
-            return True
-
-        # Inject warning right after the main content tag
-        content = re.sub(
-            r"(<main class=\"content\" id=\"quarto-document-content\">)",
-            r"\1" + warning_html,
-            content,
-            count=1,
+    # Skip if warning already present
+    if 'id="deprecation-warning"' in content:
+        return content
+
+    # Inject warning right after the main content tag; the anchor is an
+    # exact literal, so a plain replace beats a regex substitution
+    main_tag = '<main class="content" id="quarto-document-content">'
+    if main_tag not in content:
+        return content
+
+    return content.replace(main_tag, main_tag + warning_html, 1)
+
+
+def _init_worker(dropdown_cache, prefix, archive_html, versions):
+    """
+    Store the run-wide state in module globals of each pool worker.
+    """
+    global _DROPDOWN_CACHE, _PREFIX, _ARCHIVE_HTML, _VERSIONS
+    _DROPDOWN_CACHE = dropdown_cache
+    _PREFIX = prefix
+    _ARCHIVE_HTML = archive_html
+    _VERSIONS = versions
+
+
+def _process_file(html_file):
+    """
+    Read one HTML file, apply all applicable transforms and write it back.
+
+    Returns a (dropdown_ok, versions_ok, warning_ok, is_archive, skipped)
+    tuple of booleans for the parent process to aggregate into its counters.
+    """
+    current_version = detect_current_version_from_path(html_file)
+    dropdown_html = _DROPDOWN_CACHE.get(current_version)
+    if dropdown_html is None:
+        # Pages under nested .../archive/YYYY.MM.DD/ paths can detect a
+        # version that isn't a top-level archive; generate for it on the fly
+        dropdown_html = generate_dropdown_html(
+            _VERSIONS,
+            _PREFIX,
+            current_version=html.escape(current_version, quote=True),
         )
 
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(content)
+    is_archive = html_file.startswith(_ARCHIVE_PREFIX)
+    is_versions = html_file.endswith("versions.html")
+    dropdown_ok = versions_ok = warning_ok = False
 
-        return True
+    try:
+        # Probe the raw bytes via mmap so files no transform applies to are
+        # rejected before paying the UTF-8 decode
+        with open(html_file, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                content = ""
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # On fresh builds with no archives there is nothing to
+                    # inject; unless an old dropdown needs refreshing or the
+                    # file gets the warning or versions transforms anyway,
+                    # skip it without ever decoding it
+                    if (
+                        not _VERSIONS
+                        and not is_archive
+                        and not is_versions
+                        and mm.find(b'id="version-dropdown"') == -1
+                    ):
+                        return dropdown_ok, versions_ok, warning_ok, is_archive, True
+                    # A page without </nav> only fails the dropdown injection;
+                    # bail out pre-decode only when the warning and versions
+                    # transforms don't apply either
+                    if (
+                        mm.find(b"</nav>") == -1
+                        and not is_archive
+                        and not is_versions
+                    ):
+                        print(
+                            f"✗ Error updating {html_file}: ⚠ Could not find closing </nav> tag"
+                        )
+                        return dropdown_ok, versions_ok, warning_ok, is_archive, False
+                    content = mm[:].decode("utf-8")
+
+        new_content = content
+        try:
+            new_content = inject_dropdown_into_html(new_content, dropdown_html)
+            dropdown_ok = True
+        except RuntimeError as e:
+            # Keep going: archive and versions.html pages without a navbar
+            # still get their other transforms applied below
+            print(f"✗ Error updating {html_file}: {e}")
+
+        if is_archive:
+            new_content = inject_deprecation_warning(new_content, _PREFIX)
+            warning_ok = True
+
+        if is_versions:
+            new_content, versions_ok = inject_archive_versions_into_versions_html(
+                new_content, _ARCHIVE_HTML
+            )
+            if versions_ok:
+                print(f"✓ Updated archive versions in: {html_file}")
+            else:
+                print(
+                    f'⚠ Could not find automatic versions markers or a <div class="list-group"> in: {html_file}'
+                )
+
+        # Only write back if anything actually changed; write to a temp file
+        # and rename so a crash mid-write can't leave a truncated page.
+        # Encode once and write the bytes in a single unbuffered call rather
+        # than going through an incremental TextIOWrapper
+        if new_content != content:
+            tmp_file = html_file + ".tmp"
+            Path(tmp_file).write_bytes(new_content.encode("utf-8"))
+            os.replace(tmp_file, html_file)
 
     except Exception as e:
-        print(f"✗ Error injecting warning in {file_path}: {e}")
-        return False
+        print(f"✗ Error updating {html_file}: {e}")
+
+    return dropdown_ok, versions_ok, warning_ok, is_archive, False
 
 
 def main():
@@ -305,49 +481,64 @@ def main():
     versions = get_available_versions()
     print(f"📁 Found {len(versions)} archived versions: {versions}")
 
-    # Generate dropdown HTML
-    dropdown_html = generate_dropdown_html(versions, prefix)
+    # Fresh deploys with no archive have nothing to inject or refresh:
+    # dropdowns only exist in pages this script previously processed, and
+    # those all live under _site/archive — skip the whole site walk
+    if not versions and not os.path.isdir("_site/archive"):
+        print("🟡 No archived versions and no _site/archive; skipping injection.")
+        return
+
+    # Generate dropdown HTML once per distinct current_version ("Latest"
+    # plus one per archive date) instead of once per file; the badge value
+    # is HTML-escaped here, once per distinct value, rather than per file
+    dropdown_cache = {
+        cv: generate_dropdown_html(
+            versions, prefix, current_version=html.escape(cv, quote=True)
+        )
+        for cv in ["Latest", *versions]
+    }
 
     # Generate archive versions HTML
     archive_html = generate_archive_versions_html(versions, prefix)
 
-    # Find all HTML files to update
-    html_files = glob.glob("_site/**/*.html", recursive=True)
-
-    # Update dropdowns in all HTML files
+    # Each file's rewrite is independent, so fan out across all cores;
+    # per-file work is CPU-bound regex matching, hence processes not threads.
+    # Archive files are recognised by path prefix during the single walk,
+    # so no separate sweep of _site/archive is needed.
+    html_file_count = 0
+    archive_file_count = 0
     dropdown_success_count = 0
     versions_success_count = 0
-
-    for html_file in html_files:
-        current_version = detect_current_version_from_path(html_file)
-        dropdown_html = generate_dropdown_html(
-            versions, prefix, current_version=current_version
-        )
-
-        if inject_dropdown_into_html(html_file, dropdown_html):
-            dropdown_success_count += 1
-
-        if html_file.endswith("versions.html"):
-            if inject_archive_versions_into_versions_html(html_file, archive_html):
-                versions_success_count += 1
-                print(f"✓ Updated archive versions in: {html_file}")
-
-    # find all archive HTML files to update with warning
-    archive_html_files = glob.glob("_site/archive/**/*.html", recursive=True)
     warning_successs_count = 0
-
-    for archive_file in archive_html_files:
-        if inject_deprecation_warning(archive_file, prefix):
-            warning_successs_count += 1
+    skipped_count = 0
+
+    with ProcessPoolExecutor(
+        initializer=_init_worker,
+        initargs=(dropdown_cache, prefix, archive_html, versions),
+    ) as executor:
+        for dropdown_ok, versions_ok, warning_ok, is_archive, skipped in executor.map(
+            _process_file, iter_html_files("_site"), chunksize=32
+        ):
+            html_file_count += 1
+            archive_file_count += is_archive
+            dropdown_success_count += dropdown_ok
+            versions_success_count += versions_ok
+            warning_successs_count += warning_ok
+            skipped_count += skipped
+
+    if skipped_count:
+        print(
+            f"🟡 Skipped {skipped_count} HTML files with no archived versions and no existing dropdown."
+        )
 
     print(
-        f"🎉 Successfully updated {dropdown_success_count}/{len(html_files)} HTML files with version dropdown!"
+        f"🎉 Successfully updated {dropdown_success_count}/{html_file_count} HTML files with version dropdown!"
     )
     print(
         f"🎉 Successfully updated {versions_success_count} versions.html files with archive versions!"
     )
     print(
-        f"🎉 Successfully updated {warning_successs_count}/{len(archive_html_files)} archive HTML files with deprecation warning!"
+        f"🎉 Successfully updated {warning_successs_count}/{archive_file_count} archive HTML files with deprecation warning!"
     )
 
 